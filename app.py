@@ -1,10 +1,37 @@
 import os
-from flask import Flask, request, jsonify, send_from_directory
+from dotenv import load_dotenv
+
+# Read .env first, so the settings below and those libraries read at import
+# time (the thread pools, PROMETHEUS_MULTIPROC_DIR) can come from it too
+load_dotenv()
+
+# Size the OpenMP and MKL thread pools before faiss or onnxruntime start them
+os.environ.setdefault("OMP_NUM_THREADS", str(min(8, os.cpu_count() or 1)))
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["OMP_NUM_THREADS"])
+import asyncio
+from flask import Flask, Response, request, jsonify, send_from_directory, make_response
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from dotenv import load_dotenv
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram, make_wsgi_app, multiprocess
 import time
 import shutil
+import hashlib
+import hmac
+import re
+import json
+import pickle
+import threading
+import queue
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import faiss
+import numpy as np
+import pymupdf
+import redis
 
 from langchain_groq import ChatGroq
 # FIX: The 'RecursiveCharacterTextSplitter' was moved to its own dedicated package 
@@ -12,28 +39,235 @@ from langchain_groq import ChatGroq
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
 from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFDirectoryLoader
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy, maximal_marginal_relevance
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
-load_dotenv()
+# secure_filename normalizes Unicode and runs two regexes; /get-pdf asks for
+# the same few names over and over
+cached_secure_filename = lru_cache(maxsize=1024)(secure_filename)
 
 app = Flask(__name__)
 CORS(app)
 
+# Under several gunicorn workers each one keeps its own metrics, so /metrics
+# would report whichever worker served the scrape. With PROMETHEUS_MULTIPROC_DIR
+# set, workers write their samples there and /metrics aggregates all of them.
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+else:
+    metrics_registry = REGISTRY
+app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/metrics': make_wsgi_app(metrics_registry)})
+
+ask_latency = Histogram(
+    'ask_latency_seconds', 'Wall-clock time to answer a question',
+    ['cache'], buckets=(.05, .1, .25, .5, 1, 2, 5),
+)
+
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'pdf'}
+# Whole requests over MAX_CONTENT_LENGTH are refused before the body is read
+app.config['MAX_FILE_SIZE'] = int(os.getenv("MAX_FILE_SIZE_MB", 100)) << 20
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_SIZE_MB", 500)) << 20
 app.config['VECTORS'] = None
 app.config['PDF_FILENAMES'] = []
+app.config['CACHE_FOLDER'] = 'cache'
+app.config['CACHE_MAX_BYTES'] = int(os.getenv("CACHE_MAX_BYTES", 1 << 30))
+app.config['VECTORS_KEY'] = None
+app.config['SEMANTIC_CACHE_THRESHOLD'] = 0.95
+# Answers kept per corpus, in memory and in its semantic_cache.jsonl
+app.config['SEMANTIC_CACHE_SIZE'] = int(os.getenv("SEMANTIC_CACHE_SIZE", 10000))
+app.config['ANSWER_CACHE_SIZE'] = 512
+app.config['QUERY_EMBEDDING_CACHE_SIZE'] = 1024
+app.config['EXTRACT_PAGES_PER_TASK'] = 16
+app.config['EMBEDDING_BATCH_SIZE'] = 100
+app.config['EMBEDDING_CONCURRENCY'] = 16
+# Chunks stuffed into the prompt; requests may ask for up to RETRIEVAL_MAX_K
+app.config['RETRIEVAL_K'] = 4
+app.config['RETRIEVAL_MAX_K'] = 20
+# Maximal marginal relevance: pick the k chunks from the RETRIEVAL_FETCH_K
+# nearest that are relevant but unlike each other
+app.config['RETRIEVAL_MMR'] = os.getenv("RETRIEVAL_MMR", "1") == "1"
+app.config['RETRIEVAL_FETCH_K'] = 20
+app.config['RETRIEVAL_MMR_LAMBDA'] = 0.5
+app.config['ASK_BATCH_WINDOW'] = 0.02
+app.config['ASK_BATCH_SIZE'] = 32
+app.config['HNSW_M'] = 32
+app.config['HNSW_EF_CONSTRUCTION'] = 200
+app.config['HNSW_EF_SEARCH'] = int(os.getenv("HNSW_EF_SEARCH", 64))
+# Tried in order; the first that keeps recall close to exact search is used
+app.config['QUANTIZED_ENCODINGS'] = ('SQ8', 'SQfp16')
+app.config['QUANTIZED_MIN_RECALL'] = 0.95
+# Part of the cache keys: bump CHUNK_FORMAT when the way PDFs are split into
+# chunks changes, and INDEX_FORMAT when the way indexes are built changes
+app.config['CHUNK_FORMAT'] = 'chunks-2'
+app.config['INDEX_FORMAT'] = 'hnsw-cosine-5'
+# Directory of an ONNX export of a sentence embedding model (e.g. an int8
+# quantized BAAI/bge-small-en-v1.5) to embed locally instead of calling Gemini
+app.config['ONNX_EMBEDDING_MODEL'] = os.getenv("ONNX_EMBEDDING_MODEL")
+app.config['ONNX_EMBEDDING_FILE'] = os.getenv("ONNX_EMBEDDING_FILE", "model_quantized.onnx")
+app.config['ONNX_EMBEDDING_POOLING'] = os.getenv("ONNX_EMBEDDING_POOLING", "cls")
+app.config['ONNX_EMBEDDING_BATCH_SIZE'] = int(os.getenv("ONNX_EMBEDDING_BATCH_SIZE", 64))
+# Longest input the local model reads; longer chunks would be truncated
+app.config['ONNX_EMBEDDING_MAX_TOKENS'] = int(os.getenv("ONNX_EMBEDDING_MAX_TOKENS", 512))
+# Internal nginx location serving the upload folder, e.g. '/_pdf/'
+app.config['PDF_ACCEL_REDIRECT'] = os.getenv("PDF_ACCEL_REDIRECT")
+# Behind Apache mod_xsendfile or lighttpd, send_from_directory answers with an
+# X-Sendfile header and the server sends the file itself
+app.config['USE_X_SENDFILE'] = os.getenv("USE_X_SENDFILE") == "1"
+# Seconds browsers may reuse a fetched PDF without asking again. The default
+# of 0 still saves the transfer, with a 304 when the ETag matches, and a new
+# upload under the same name is never shown stale.
+app.config['PDF_MAX_AGE'] = int(os.getenv("PDF_MAX_AGE", 0))
+
+# With several gunicorn workers, the current corpus is shared through Redis
+redis_url = os.getenv("REDIS_URL")
+redis_client = redis.Redis.from_url(redis_url) if redis_url else None
+# Persisted indexes are also copied to Redis for workers on this host that do
+# not share the cache folder. The copies are signed with SHARED_INDEX_SECRET,
+# and are neither written nor read without it.
+app.config['SHARED_INDEX_TTL'] = int(os.getenv("SHARED_INDEX_TTL", 24 * 3600))
+app.config['SHARED_INDEX_SECRET'] = os.getenv("SHARED_INDEX_SECRET")
+# Seconds before the Redis upload lock of a killed worker expires; longer than
+# gunicorn's timeout, so it never expires under a live upload
+app.config['UPLOAD_LOCK_TIMEOUT'] = int(os.getenv("UPLOAD_LOCK_TIMEOUT", 300))
 
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
+if not os.path.exists(app.config['CACHE_FOLDER']):
+    os.makedirs(app.config['CACHE_FOLDER'])
 
 groq_api_key = os.getenv("GROQ_API_KEY")
-os.environ['GOOGLE_API_KEY'] = os.getenv("GOOGLE_API_KEY")
+
+# Let FAISS use several cores for batched searches and index builds
+faiss.omp_set_num_threads(int(os.getenv("FAISS_NUM_THREADS", os.environ["OMP_NUM_THREADS"])))
+
+class OnnxEmbeddings(Embeddings):
+    # Sentence embeddings computed in-process with ONNX Runtime, so embedding
+    # a batch costs CPU time rather than a round-trip to a remote API.
+    def __init__(self, model_path, file_name, pooling, batch_size, max_length, num_threads):
+        # Optional dependencies, only needed when a local model is configured
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        # Parallelism comes from the matrix kernels within one run; batches
+        # run one at a time, so inter-op threads would only sit idle.
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+        # Fuse attention, LayerNorm and GELU into single kernels when loading
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_path, file_name=file_name, provider="CPUExecutionProvider", session_options=session_options
+        )
+        self.pooling = pooling
+        self.batch_size = batch_size
+        self.max_length = max_length
+        # The first run allocates ONNX Runtime's memory arena; pay for it here
+        # rather than in the first upload or question
+        self.embed_query("warmup")
+
+    def embed_documents(self, texts, **kwargs):
+        # kwargs such as task_type only apply to the Gemini API
+        # Batch texts of similar length together so little of each batch is padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            inputs = self.tokenizer(
+                [texts[i] for i in batch], padding=True, truncation=True, max_length=self.max_length,
+                return_tensors="np",
+            )
+            hidden = self.model(**inputs).last_hidden_state
+            if self.pooling == "mean":
+                mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            else:
+                pooled = hidden[:, 0]
+            pooled = np.ascontiguousarray(pooled, dtype='float32')
+            faiss.normalize_L2(pooled)
+            for i, vector in zip(batch, pooled.tolist()):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text, **kwargs):
+        return self.embed_documents([text])[0]
+
+class ProcessLocalEmbeddings(Embeddings):
+    # Creates the real embedding client on first use in each process. gRPC
+    # channels and ONNX Runtime thread pools do not survive a fork, so a
+    # client built in gunicorn's master (preload_app) must not reach workers.
+    def __init__(self, factory):
+        self.factory = factory
+        self.client = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.client = self.factory()
+                self.pid = os.getpid()
+        return self.client
+
+    def embed_documents(self, texts, **kwargs):
+        return self.get().embed_documents(texts, **kwargs)
+
+    def embed_query(self, text, **kwargs):
+        return self.get().embed_query(text, **kwargs)
+
+    async def aembed_documents(self, texts):
+        return await self.get().aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        return await self.get().aembed_query(text)
+
+def create_embeddings():
+    if app.config['ONNX_EMBEDDING_MODEL']:
+        return OnnxEmbeddings(
+            app.config['ONNX_EMBEDDING_MODEL'],
+            app.config['ONNX_EMBEDDING_FILE'],
+            app.config['ONNX_EMBEDDING_POOLING'],
+            app.config['ONNX_EMBEDDING_BATCH_SIZE'],
+            app.config['ONNX_EMBEDDING_MAX_TOKENS'],
+            int(os.environ["OMP_NUM_THREADS"]),
+        )
+    return GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+
+def create_text_splitter():
+    if app.config['ONNX_EMBEDDING_MODEL']:
+        from transformers import AutoTokenizer
+
+        # Measure chunks in the model's own tokens, so none is cut short by
+        # truncation before it is embedded ([CLS] and [SEP] take two tokens)
+        tokenizer = AutoTokenizer.from_pretrained(app.config['ONNX_EMBEDDING_MODEL'])
+        return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer, chunk_size=app.config['ONNX_EMBEDDING_MAX_TOKENS'] - 2, chunk_overlap=32
+        )
+    # The sizes load_and_split() used before: about a page of text per chunk
+    return RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200)
 
 llm = ChatGroq(groq_api_key=groq_api_key, model_name="gemma2-9b-it")
+embeddings = ProcessLocalEmbeddings(create_embeddings)
+# Part of the cache keys, so it names every setting that changes the chunks
+# or their vectors
+if app.config['ONNX_EMBEDDING_MODEL']:
+    embedding_model_name = ':'.join([
+        app.config['ONNX_EMBEDDING_MODEL'],
+        app.config['ONNX_EMBEDDING_FILE'],
+        app.config['ONNX_EMBEDDING_POOLING'],
+        str(app.config['ONNX_EMBEDDING_MAX_TOKENS']),
+    ])
+else:
+    embedding_model_name = "models/embedding-001"
+text_splitter = create_text_splitter()
 
 prompt = ChatPromptTemplate.from_template(
     """
@@ -45,21 +279,648 @@ prompt = ChatPromptTemplate.from_template(
     Questions:{input}
     """
 )
+# Built once: the chain does not depend on the corpus, since /ask passes the
+# retrieved documents in directly.
+document_chain = create_stuff_documents_chain(llm, prompt)
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+# Exact repeats of a question skip even the embedding call
+answer_cache = LRUCache(app.config['ANSWER_CACHE_SIZE'])
+query_embedding_cache = LRUCache(app.config['QUERY_EMBEDDING_CACHE_SIZE'])
+
+class SemanticCache:
+    # Remembers answers by question embedding, so a repeated or reworded
+    # question is answered without another retrieval and LLM round-trip.
+    # Entries are appended to a file next to the corpus index, so they
+    # survive restarts and reach workers that load the corpus later.
+    def __init__(self, dimension, threshold, path, size):
+        self.index = faiss.IndexFlatIP(dimension)
+        self.threshold = threshold
+        self.size = size
+        self.responses = []
+        self.lock = threading.Lock()
+        self.path = path
+        # Lines in the file, so appends stop once it holds size entries
+        self.persisted = 0
+        if os.path.exists(path):
+            entries = []
+            with open(path) as f:
+                for line in f:
+                    self.persisted += 1
+                    # Skip lines torn by a crash or a full disk mid-append
+                    try:
+                        entry = json.loads(line)
+                        vector, response = entry['vector'], entry['response']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if len(vector) == dimension:
+                        entries.append((vector, response))
+            entries = entries[-size:]
+            if entries:
+                self.index.add(np.array([vector for vector, _ in entries], dtype='float32'))
+                self.responses = [response for _, response in entries]
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.array([embedding], dtype='float32')
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, vector):
+        with self.lock:
+            if self.index.ntotal == 0:
+                return None
+            scores, ids = self.index.search(vector, 1)
+            if scores[0, 0] > self.threshold:
+                return self.responses[ids[0, 0]]
+        return None
+
+    def add(self, vector, response):
+        with self.lock:
+            if self.index.ntotal >= self.size:
+                # Forget the oldest quarter at once rather than shift the
+                # index on every add
+                dropped = max(1, self.size // 4)
+                self.index.remove_ids(np.arange(dropped))
+                del self.responses[:dropped]
+            self.index.add(vector)
+            self.responses.append(response)
+            if self.persisted >= self.size:
+                return
+            self.persisted += 1
+            line = json.dumps({'vector': vector[0].tolist(), 'response': response}) + '\n'
+            try:
+                # One write on an O_APPEND descriptor, so lines appended by
+                # several workers at once do not interleave
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line.encode())
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                # The corpus folder may have been evicted; the entry stays in memory
+                print(f'Failed to persist semantic cache entry. Reason: {e}')
+
+def embed_queries(questions):
+    known = {question: query_embedding_cache.get(question) for question in questions}
+    missing = [question for question, vector in known.items() if vector is None]
+    if len(missing) == 1:
+        known[missing[0]] = embeddings.embed_query(missing[0])
+    elif missing:
+        # embed_documents defaults to the document task type; questions are queries
+        known.update(zip(missing, embeddings.embed_documents(missing, task_type="RETRIEVAL_QUERY")))
+    for question in missing:
+        query_embedding_cache.put(question, known[question])
+    return [known[question] for question in questions]
+
+def batch_similarity_search(vectors, query_embeddings, ks):
+    queries = np.array(query_embeddings, dtype='float32')
+    faiss.normalize_L2(queries)
+    if not app.config['RETRIEVAL_MMR']:
+        _, indices = vectors.index.search(queries, max(ks))
+        return [[vectors.documents[i] for i in row[:k] if i != -1] for row, k in zip(indices, ks)]
+    # Overlapping and repeated chunks would otherwise fill the prompt with
+    # the same text several times
+    _, indices = vectors.index.search(queries, max(app.config['RETRIEVAL_FETCH_K'], *ks))
+    results = []
+    for query, row, k in zip(queries, indices, ks):
+        row = row[row != -1]
+        chosen = maximal_marginal_relevance(
+            query, vectors.index.reconstruct_batch(row), app.config['RETRIEVAL_MMR_LAMBDA'], k
+        ) if len(row) else []
+        results.append([vectors.documents[row[i]] for i in chosen])
+    return results
+
+class QueryBatcher:
+    # Questions arriving within a short window from concurrent /ask requests
+    # share one embedding request and one batched FAISS search.
+    def __init__(self, window, max_batch_size):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker_pid = None
+
+    def submit(self, vectors, question, k):
+        # Start the collector lazily, so each forked gunicorn worker runs its own
+        with self.lock:
+            if self.worker_pid != os.getpid():
+                self.worker_pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+        future = Future()
+        self.queue.put((vectors, question, k, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.process(batch)
+
+    def process(self, batch):
+        try:
+            query_embeddings = embed_queries([question for _, question, _, _ in batch])
+            # An upload may swap the corpus mid-batch, so search per vector store
+            groups = {}
+            for position, (vectors, _, _, _) in enumerate(batch):
+                groups.setdefault(id(vectors), (vectors, []))[1].append(position)
+            for vectors, positions in groups.values():
+                results = batch_similarity_search(
+                    vectors, [query_embeddings[p] for p in positions], [batch[p][2] for p in positions]
+                )
+                for position, docs in zip(positions, results):
+                    batch[position][3].set_result((query_embeddings[position], docs))
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+query_batcher = QueryBatcher(app.config['ASK_BATCH_WINDOW'], app.config['ASK_BATCH_SIZE'])
+
+def stable_chunk_order(docs):
+    # Retrieved chunks are stuffed into the prompt in document order rather than
+    # score order, so questions hitting the same chunks produce an identical
+    # prompt prefix that the provider's prompt cache can reuse. Chunks of one
+    # page are ordered by their position on it, not left in score order.
+    return sorted(
+        docs,
+        key=lambda doc: (doc.metadata.get("source", ""), doc.metadata.get("page", 0), doc.metadata.get("chunk", 0)),
+    )
+
+allowed_extension_search = re.compile(
+    r'\.(?:%s)\Z' % '|'.join(map(re.escape, app.config['ALLOWED_EXTENSIONS'])), re.IGNORECASE
+).search
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
-def vector_embedding(directory):
-    # NOTE: The RecursiveCharacterTextSplitter is imported but not explicitly used here,
-    # as PyPDFDirectoryLoader.load_and_split() typically handles splitting internally.
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-    loader = PyPDFDirectoryLoader(directory)
-    pages = loader.load_and_split()
-    vectors = FAISS.from_documents(pages, embeddings)
+    return bool(allowed_extension_search(filename))
+
+def extract_pages(task):
+    # Split in the worker too: chunks never span pages, and splitting is as
+    # CPU-bound as the extraction itself
+    path, start, stop = task
+    with pymupdf.open(path) as pdf:
+        return [text_splitter.split_text(pdf[page_number].get_text()) for page_number in range(start, stop)]
+
+def page_range_tasks(paths):
+    # Split every PDF into ranges of pages, so a single large PDF is also
+    # spread across all worker processes.
+    tasks = []
+    for path in paths:
+        with pymupdf.open(path) as pdf:
+            page_count = pdf.page_count
+        step = app.config['EXTRACT_PAGES_PER_TASK']
+        tasks.extend((path, start, min(start + step, page_count)) for start in range(0, page_count, step))
+    return tasks
+
+def load_pdf_chunks(directory):
+    # Extract and split the PDFs in parallel processes with PyMuPDF, keeping
+    # each chunk's source file and 0-indexed page number.
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if allowed_file(f))
+    tasks = page_range_tasks(paths)
+    chunks = []
+    if len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1)) as executor:
+            results = list(executor.map(extract_pages, tasks))
+    else:
+        # Starting worker processes costs more than extracting a few pages
+        results = [extract_pages(task) for task in tasks]
+    for (path, start, _), pages in zip(tasks, results):
+        for page_number, page_chunks in enumerate(pages, start):
+            # Citations show the bare filename and a 1-indexed page number
+            metadata = {
+                "source": path,
+                "page": page_number,
+                "display_source": os.path.basename(path),
+                "display_page": page_number + 1,
+            }
+            chunks.extend(
+                Document(page_content=text, metadata={**metadata, "chunk": chunk_number})
+                for chunk_number, text in enumerate(page_chunks)
+            )
+    return chunks
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        # file_digest (Python 3.11+) reads into one reused buffer and hashes
+        # it with the GIL released
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def save_upload(file, filepath):
+    # Copy the upload to disk in 1 MiB blocks, hashing each block on the way so
+    # the corpus key does not read the file again. The buffered writer passes
+    # blocks this large straight through, and retries short writes.
+    # Returns None, keeping nothing on disk, once it exceeds MAX_FILE_SIZE.
+    digest = hashlib.sha256()
+    size = 0
+    with open(filepath, 'wb') as destination:
+        for block in iter(lambda: file.stream.read(1 << 20), b''):
+            size += len(block)
+            if size > app.config['MAX_FILE_SIZE']:
+                break
+            digest.update(block)
+            destination.write(block)
+    if size > app.config['MAX_FILE_SIZE']:
+        os.remove(filepath)
+        return None
+    return digest.hexdigest()
+
+def corpus_key(directory, file_digests=None, formats=None):
+    # Identify an uploaded corpus by its filenames and contents, so re-uploading
+    # the same PDFs can reuse the index persisted for them.
+    file_digests = file_digests or {}
+    formats = formats or (app.config['CHUNK_FORMAT'], app.config['INDEX_FORMAT'])
+    digest = hashlib.sha256(f"{';'.join(formats)};{embedding_model_name};".encode())
+    for filename in sorted(f for f in os.listdir(directory) if allowed_file(f)):
+        file_digest = file_digests.get(filename) or file_sha256(os.path.join(directory, filename))
+        digest.update(f'{filename}:{file_digest};'.encode())
+    return digest.hexdigest()
+
+def cached_index_path(key):
+    return os.path.join(app.config['CACHE_FOLDER'], key)
+
+def file_size(path):
+    # Other workers replace, stage and evict files while the cache is scanned
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def folder_size(path):
+    return sum(
+        file_size(os.path.join(root, filename))
+        for root, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+def evict_cached_indexes(keep):
+    # Drop the least recently used indexes once the cache outgrows its cap.
+    # Staging folders belong to saves still in progress, and entries can
+    # disappear mid-scan when another worker evicts or renames them.
+    folder = app.config['CACHE_FOLDER']
+    entries = []
+    for key in os.listdir(folder):
+        if key == keep or '.tmp-' in key:
+            continue
+        path = os.path.join(folder, key)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    entries.sort()
+    total = folder_size(folder)
+    for _, path in entries:
+        if total <= app.config['CACHE_MAX_BYTES']:
+            break
+        total -= folder_size(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+# Memory-map the stored vectors instead of copying them into each worker.
+# IO_FLAG_MMAP_IFC (faiss >= 1.10) also covers the flat codes under HNSW.
+MMAP_READ_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+INDEX_FILES = ('index.faiss', 'index.pkl')
+
+def index_signature(key, name, blob):
+    # index.pkl is unpickled when loaded, so a blob anyone with access to
+    # Redis could have written must carry an HMAC of the app's secret
+    message = f'{key}:{name}:'.encode() + blob
+    return hmac.new(app.config['SHARED_INDEX_SECRET'].encode(), message, hashlib.sha256).digest()
+
+def share_cached_index(key):
+    if redis_client is None or not app.config['SHARED_INDEX_SECRET']:
+        return
+    if redis_client.exists(f'index:{key}:index.faiss'):
+        return
+    path = cached_index_path(key)
+    pipe = redis_client.pipeline()
+    for name in INDEX_FILES:
+        with open(os.path.join(path, name), 'rb') as f:
+            blob = f.read()
+        pipe.set(f'index:{key}:{name}', index_signature(key, name, blob) + blob, ex=app.config['SHARED_INDEX_TTL'])
+    pipe.execute()
+
+def fetch_shared_index(key):
+    # Copy an index built by another host into the local cache folder, so it
+    # can be memory-mapped like one built here.
+    if redis_client is None or not app.config['SHARED_INDEX_SECRET']:
+        return False
+    blobs = redis_client.mget([f'index:{key}:{name}' for name in INDEX_FILES])
+    if not all(blobs):
+        return False
+    size = hashlib.sha256().digest_size
+    for name, blob in zip(INDEX_FILES, blobs):
+        if not hmac.compare_digest(blob[:size], index_signature(key, name, blob[size:])):
+            print(f'Ignoring shared {name} for {key}: bad signature')
+            return False
+    blobs = [blob[size:] for blob in blobs]
+    path = cached_index_path(key)
+    staging = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    os.makedirs(staging)
+    for name, blob in zip(INDEX_FILES, blobs):
+        with open(os.path.join(staging, name), 'wb') as f:
+            f.write(blob)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Another worker got there first
+        shutil.rmtree(staging, ignore_errors=True)
+    return True
+
+def load_cached_vectors(key):
+    path = cached_index_path(key)
+    index_file = os.path.join(path, 'index.faiss')
+    if not os.path.exists(index_file) and not fetch_shared_index(key):
+        return None
+    try:
+        index = faiss.read_index(index_file, MMAP_READ_FLAGS)
+        # The docstore was pickled by this app's save_local, here or by a worker
+        # whose copy in Redis carried a valid signature, so loading it is safe.
+        with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    except Exception as e:
+        # Cut short by an in-place save from before indexes were staged, or
+        # damaged on disk: drop it so the next upload rebuilds it
+        print(f'Discarding unreadable index {path}. Reason: {e}')
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    # efSearch is a query-time knob: apply the current setting to old indexes too
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = app.config['HNSW_EF_SEARCH']
+    # Mark the index as recently used for eviction
+    os.utime(path)
+    return wrap_index(index, docstore, index_to_docstore_id, key)
+
+def save_cached_vectors(key, vectors):
+    # Save into a staging folder and rename it into place, so a worker killed
+    # mid-save never leaves a folder that looks like a complete index
+    path = cached_index_path(key)
+    staging = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    vectors.save_local(staging)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Another worker got there first
+        shutil.rmtree(staging, ignore_errors=True)
+
+def load_cached_embeddings(path, count):
+    embeddings_file = os.path.join(path, 'embeddings.npy')
+    if not os.path.exists(embeddings_file):
+        return None
+    matrix = np.load(embeddings_file, mmap_mode='r')
+    if matrix.shape[0] != count:
+        return None
+    os.utime(path)
+    return matrix.astype('float32')
+
+def save_cached_embeddings(path, matrix):
+    # float16 halves the file, and is plenty for vectors that end up int8
+    # quantized or ranked by cosine similarity
+    os.makedirs(path, exist_ok=True)
+    staging = os.path.join(path, f'embeddings.{os.getpid()}.npy')
+    np.save(staging, matrix.astype('float16'))
+    os.replace(staging, os.path.join(path, 'embeddings.npy'))
+
+class BackgroundLoop:
+    # One event loop per process, on a daemon thread. The Gemini client binds
+    # its async gRPC channel to the loop it was created on, so every upload
+    # has to run on that same loop: a fresh loop per upload (asyncio.run)
+    # would break the channel on the second upload and drop its connection.
+    def __init__(self):
+        self.loop = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def run(self, coroutine):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+                self.pid = os.getpid()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+embedding_loop = BackgroundLoop()
+
+async def embed_texts(texts):
+    # Embedding is bound by round-trips to the remote API, so send the batches
+    # concurrently, capped by a semaphore to stay within the API quota.
+    semaphore = asyncio.Semaphore(app.config['EMBEDDING_CONCURRENCY'])
+    batch_size = app.config['EMBEDDING_BATCH_SIZE']
+    matrix = None
+
+    async def embed_batch(start):
+        nonlocal matrix
+        async with semaphore:
+            vectors = await embeddings.aembed_documents(texts[start:start + batch_size])
+        if matrix is None:
+            matrix = np.empty((len(texts), len(vectors[0])), dtype='float32')
+        matrix[start:start + len(vectors)] = vectors
+
+    await asyncio.gather(*(embed_batch(start) for start in range(0, len(texts), batch_size)))
+    return matrix
+
+def embed_texts_locally(texts):
+    # CPU-bound: concurrent batches would only contend for the same cores
+    step = app.config['ONNX_EMBEDDING_BATCH_SIZE'] * 16
+    matrix = None
+    for start in range(0, len(texts), step):
+        vectors = embeddings.embed_documents(texts[start:start + step])
+        if matrix is None:
+            matrix = np.empty((len(texts), len(vectors[0])), dtype='float32')
+        matrix[start:start + len(vectors)] = vectors
+    return matrix
+
+class RowIndexedFAISS(FAISS):
+    # Keeps the documents in a list ordered by FAISS row id, so a search hit
+    # maps to its Document with one list index instead of two dict lookups.
+    # It also carries its corpus key and semantic cache, so a request keeps
+    # answering from, and caching into, the corpus it started with even if an
+    # upload replaces it meanwhile.
+    def __init__(self, *args, corpus_key=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.documents = [
+            self.docstore.search(self.index_to_docstore_id[row]) for row in range(self.index.ntotal)
+        ]
+        self.corpus_key = corpus_key
+        self.semantic_cache = None
+        self.semantic_cache_lock = threading.Lock()
+
+    def get_semantic_cache(self):
+        with self.semantic_cache_lock:
+            if self.semantic_cache is None:
+                self.semantic_cache = SemanticCache(
+                    self.index.d, app.config['SEMANTIC_CACHE_THRESHOLD'],
+                    os.path.join(cached_index_path(self.corpus_key), 'semantic_cache.jsonl'),
+                    app.config['SEMANTIC_CACHE_SIZE'],
+                )
+            return self.semantic_cache
+
+def wrap_index(index, docstore, index_to_docstore_id, key):
+    # Stored vectors are L2-normalized, so inner product ranks by cosine
+    # similarity (the query's own norm does not change the ranking)
+    return RowIndexedFAISS(
+        embeddings, index, docstore, index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT, corpus_key=key,
+    )
+
+def build_hnsw_index(matrix, encoding):
+    index = faiss.index_factory(
+        matrix.shape[1], f"HNSW{app.config['HNSW_M']},{encoding}", faiss.METRIC_INNER_PRODUCT
+    )
+    index.hnsw.efConstruction = app.config['HNSW_EF_CONSTRUCTION']
+    index.train(matrix)
+    index.add(matrix)
+    index.hnsw.efSearch = app.config['HNSW_EF_SEARCH']
+    return index
+
+def recall_at_k(index, matrix, k=5, sample_size=100):
+    # Fraction of the exact top-k neighbours the index finds, using a sample
+    # of the stored vectors as queries. faiss.knn searches the matrix as it
+    # is, without copying it into a flat index first.
+    rng = np.random.default_rng(0)
+    queries = matrix[rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)]
+    _, expected = faiss.knn(queries, matrix, k, metric=faiss.METRIC_INNER_PRODUCT)
+    _, found = index.search(queries, k)
+    hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+    return hits / expected.size
+
+def build_index(matrix):
+    # Use an HNSW graph instead of the default exact flat index, so retrieval
+    # stays logarithmic in the number of chunks. Vectors are stored quantized
+    # (int8, else float16) when that keeps recall@5 close to an exact search.
+    for encoding in app.config['QUANTIZED_ENCODINGS']:
+        index = build_hnsw_index(matrix, encoding)
+        if recall_at_k(index, matrix) >= app.config['QUANTIZED_MIN_RECALL']:
+            return index
+    return build_hnsw_index(matrix, 'Flat')
+
+def build_vector_store(pages, matrix, key):
+    faiss.normalize_L2(matrix)
+    index = build_index(matrix)
+
+    ids = [str(i) for i in range(len(pages))]
+    docstore = InMemoryDocstore(dict(zip(ids, pages)))
+    return wrap_index(index, docstore, dict(enumerate(ids)), key)
+
+def vector_embedding(directory, file_digests=None):
+    key = corpus_key(directory, file_digests)
+    vectors = load_cached_vectors(key)
+    if vectors is None:
+        pages = load_pdf_chunks(directory)
+        if not pages:
+            return None
+        texts = [page.page_content for page in pages]
+        # Embeddings are cached apart from the index, under a key without
+        # INDEX_FORMAT, so rebuilding the index in a new format does not
+        # embed the whole corpus again.
+        embeddings_path = cached_index_path(
+            corpus_key(directory, file_digests, (app.config['CHUNK_FORMAT'],))
+        )
+        matrix = load_cached_embeddings(embeddings_path, len(texts))
+        if matrix is None:
+            # Embed each distinct text once: running headers, footers and
+            # boilerplate pages repeat across a corpus
+            rows = {}
+            text_rows = [rows.setdefault(text, len(rows)) for text in texts]
+            # Embeddings are written straight into one float32 matrix: as lists
+            # of Python floats they would take several times the memory.
+            if app.config['ONNX_EMBEDDING_MODEL']:
+                matrix = embed_texts_locally(list(rows))
+            else:
+                matrix = embedding_loop.run(embed_texts(list(rows)))
+            if len(rows) < len(texts):
+                matrix = matrix[text_rows]
+            save_cached_embeddings(embeddings_path, matrix)
+        vectors = build_vector_store(pages, matrix, key)
+        save_cached_vectors(key, vectors)
+        evict_cached_indexes(keep=key)
+    try:
+        share_cached_index(key)
+    except (redis.RedisError, OSError) as e:
+        # Sharing is optional, e.g. an index over Redis's 512 MB value limit
+        # stays local; the upload itself succeeded
+        print(f'Failed to share index {key}. Reason: {e}')
+    app.config['VECTORS_KEY'] = key
     return vectors
 
-def clear_upload_folder():
-    folder = app.config['UPLOAD_FOLDER']
+def publish_corpus(key, filenames):
+    if redis_client is not None:
+        redis_client.mset({'pdf:key': key or '', 'pdf:filenames': json.dumps(filenames)})
+
+def current_corpus_key():
+    if redis_client is not None:
+        key = redis_client.get('pdf:key')
+        return key.decode() if key else None
+    # After a restart app.config is empty, but the uploaded PDFs and their
+    # persisted index are still on disk. Hash them once and keep the key even
+    # if its index cannot be loaded, so later requests do not rehash every PDF.
+    if app.config['VECTORS_KEY'] is None and app.config['PDF_FILENAMES']:
+        app.config['VECTORS_KEY'] = corpus_key(app.config['UPLOAD_FOLDER'])
+    return app.config['VECTORS_KEY']
+
+def current_pdf_filenames():
+    if redis_client is not None:
+        filenames = redis_client.get('pdf:filenames')
+        return json.loads(filenames) if filenames else []
+    return app.config['PDF_FILENAMES']
+
+vectors_lock = threading.Lock()
+
+def get_vectors():
+    # Load the persisted index on first use of a corpus in this worker, e.g.
+    # after a restart or when another worker handled the upload.
+    key = current_corpus_key()
+    if key is None:
+        return None
+    # Callers take the corpus key and semantic cache from the returned store,
+    # never from app.config, which an upload may change mid-request
+    vectors = app.config['VECTORS']
+    if vectors is not None and vectors.corpus_key == key:
+        return vectors
+    # One thread loads the index while the others wait for it, instead of
+    # every concurrent /ask loading its own copy
+    with vectors_lock:
+        vectors = app.config['VECTORS']
+        if vectors is None or vectors.corpus_key != key:
+            vectors = load_cached_vectors(key)
+            if vectors is None:
+                return None
+            app.config['VECTORS'] = vectors
+            app.config['VECTORS_KEY'] = key
+        return vectors
+
+def delete_folder_contents(folder):
     for filename in os.listdir(folder):
         file_path = os.path.join(folder, filename)
         try:
@@ -69,78 +930,228 @@ def clear_upload_folder():
                 shutil.rmtree(file_path)
         except Exception as e:
             print(f'Failed to delete {file_path}. Reason: {e}')
+
+def clear_upload_folder(replacement=None):
+    folder = app.config['UPLOAD_FOLDER']
+    # Move the previous session's files aside and delete them on a background
+    # thread, so the new upload does not wait for the unlinks.
+    trash = f'{folder}.gc-{time.time_ns()}'
+    try:
+        os.rename(folder, trash)
+    except OSError as e:
+        print(f'Failed to move {folder} aside. Reason: {e}')
+        delete_folder_contents(folder)
+    else:
+        threading.Thread(target=shutil.rmtree, args=(trash,), kwargs={'ignore_errors': True}, daemon=True).start()
+    # Put the new upload's staging folder, if any, in its place
+    if replacement is None:
+        os.makedirs(folder, exist_ok=True)
+    elif os.path.exists(folder):
+        for filename in os.listdir(replacement):
+            os.replace(os.path.join(replacement, filename), os.path.join(folder, filename))
+        os.rmdir(replacement)
+    else:
+        os.rename(replacement, folder)
     app.config['PDF_FILENAMES'] = []
+    app.config['VECTORS'] = None
+    app.config['VECTORS_KEY'] = None
+    publish_corpus(None, [])
+
+def restore_pdf_filenames():
+    folder = app.config['UPLOAD_FOLDER']
+    app.config['PDF_FILENAMES'] = sorted(f for f in os.listdir(folder) if allowed_file(f))
+
+def remove_stale_upload_folders():
+    # Folders moved aside by clear_upload_folder, and uploads still being
+    # staged, outlive a crash or restart that interrupted them
+    folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    prefixes = tuple(os.path.basename(folder) + suffix for suffix in ('.gc-', '.new-'))
+    parent = os.path.dirname(folder)
+    for name in os.listdir(parent):
+        if name.startswith(prefixes):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+restore_pdf_filenames()
+remove_stale_upload_folders()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload is larger than {app.config['MAX_CONTENT_LENGTH'] >> 20} MB"}), 413
+
+upload_lock = threading.Lock()
+
+def corpus_upload_lock():
+    # Workers sharing a corpus through Redis also share the upload folder, so
+    # their uploads have to take turns too
+    if redis_client is not None:
+        return redis_client.lock('pdf:upload', timeout=app.config['UPLOAD_LOCK_TIMEOUT'])
+    return upload_lock
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
-    clear_upload_folder()
+    # An upload replaces the whole corpus, so run them one at a time: two
+    # interleaved uploads would clear each other's files mid-build
+    with corpus_upload_lock():
+        return replace_corpus()
+
+def replace_corpus():
+    # Reading request.files parses the body, so an upload over
+    # MAX_CONTENT_LENGTH is refused here, before the current corpus is touched
     if 'files' not in request.files:
         return jsonify({"error": "No files part"}), 400
 
     uploaded_files = request.files.getlist('files')
     uploaded_filenames = []
+    file_digests = {}
 
-    for file in uploaded_files:
-        if file.filename == '':
-            return jsonify({"error": "No selected file"}), 400
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            uploaded_filenames.append(filename)
-            app.config['PDF_FILENAMES'].append(filename)
-        else:
-            return jsonify({"error": "File type not allowed"}), 400
+    # Save into a staging folder, and replace the current corpus only once
+    # every file has been accepted
+    staging = f"{app.config['UPLOAD_FOLDER']}.new-{time.time_ns()}"
+    os.makedirs(staging)
+    try:
+        for file in uploaded_files:
+            if file.filename == '':
+                return jsonify({"error": "No selected file"}), 400
+            if file and allowed_file(file.filename):
+                filename = cached_secure_filename(file.filename)
+                filepath = os.path.join(staging, filename)
+                file_digests[filename] = save_upload(file, filepath)
+                if file_digests[filename] is None:
+                    return jsonify({"error": f"{filename} is larger than {app.config['MAX_FILE_SIZE'] >> 20} MB"}), 413
+                uploaded_filenames.append(filename)
+            else:
+                return jsonify({"error": "File type not allowed"}), 400
+        clear_upload_folder(staging)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
 
     # Perform vector embedding after all files are uploaded
-    app.config['VECTORS'] = vector_embedding(app.config['UPLOAD_FOLDER'])
+    vectors = vector_embedding(app.config['UPLOAD_FOLDER'], file_digests)
+    if vectors is None:
+        # e.g. scanned PDFs without a text layer
+        clear_upload_folder()
+        return jsonify({"error": "No extractable text in the uploaded PDFs"}), 400
+    app.config['VECTORS'] = vectors
+    # Publish the names in one assignment, once the corpus can be queried
+    app.config['PDF_FILENAMES'] = list(dict.fromkeys(uploaded_filenames))
+    publish_corpus(app.config['VECTORS_KEY'], app.config['PDF_FILENAMES'])
 
     return jsonify({"message": "Files uploaded and vector store ready", "uploaded_files": uploaded_filenames}), 200
 
+def format_context(context):
+    # Cite each source page once, in retrieval order (dict keys keep insertion order)
+    if not context:
+        return None
+    pages = dict.fromkeys(
+        (doc.metadata.get("display_source"), doc.metadata.get("display_page")) for doc in context
+    )
+    return [
+        {"source": source_name, "page": page}
+        for source_name, page in pages
+        if source_name and page is not None
+    ]
+
+def server_sent_event(payload, event=None):
+    name = f"event: {event}\n" if event else ""
+    return f"{name}data: {json.dumps(payload)}\n\n"
+
+# Named final event: an EventSource reconnects when the stream ends, and would
+# ask the same question again every few seconds unless the client closes it
+STREAM_DONE_EVENT = server_sent_event({}, event="done")
+
+def remember_answer(answer_key, query_vector, semantic_cache, cached):
+    answer_cache.put(answer_key, cached)
+    if semantic_cache is not None:
+        semantic_cache.add(query_vector, cached)
+
+def cached_response(cached, start, stream):
+    response_time = time.perf_counter() - start
+    ask_latency.labels(cache='hit').observe(response_time)
+    if stream:
+        events = [
+            server_sent_event({"answer": cached["answer"]}),
+            server_sent_event({"context": cached["context"], "response_time": response_time}),
+            STREAM_DONE_EVENT,
+        ]
+        return Response(events, mimetype='text/event-stream')
+    return jsonify({**cached, "response_time": response_time})
+
+def stream_answer(question, context, formatted_context, answer_key, query_vector, semantic_cache, start):
+    # Send each answer token as it arrives, then the sources in a final event
+    tokens = []
+    for token in document_chain.stream({'input': question, 'context': context}):
+        tokens.append(token)
+        yield server_sent_event({"answer": token})
+    response_time = time.perf_counter() - start
+    ask_latency.labels(cache='miss').observe(response_time)
+    remember_answer(answer_key, query_vector, semantic_cache, {"answer": ''.join(tokens), "context": formatted_context})
+    yield server_sent_event({"context": formatted_context, "response_time": response_time})
+    yield STREAM_DONE_EVENT
+
 @app.route('/ask', methods=['POST'])
 def ask_question():
     data = request.get_json()
-    question = data.get('question')
+    # Clients that accept text/event-stream get the answer streamed token by token
+    stream = request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+    return answer_question(data.get('question'), data.get('k'), stream)
+
+@app.route('/ask-stream', methods=['GET', 'POST'])
+def ask_question_stream():
+    # Always streams; GET takes ?question= so a browser EventSource can connect
+    params = request.args if request.method == 'GET' else request.get_json()
+    return answer_question(params.get('question'), params.get('k'), stream=True)
+
+def answer_question(question, k, stream):
     if not question:
         return jsonify({"error": "No question provided"}), 400
+    try:
+        k = app.config['RETRIEVAL_K'] if k is None else int(k)
+    except (TypeError, ValueError):
+        k = 0
+    if not 1 <= k <= app.config['RETRIEVAL_MAX_K']:
+        return jsonify({"error": f"k must be between 1 and {app.config['RETRIEVAL_MAX_K']}"}), 400
 
-    if not app.config['VECTORS']:
+    vectors = get_vectors()
+    if vectors is None:
         return jsonify({"error": "No vectors available. Upload a PDF first."}), 400
 
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = app.config['VECTORS'].as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
-    start = time.process_time()
-    response = retrieval_chain.invoke({'input': question})
-    response_time = time.process_time() - start
-
-    answer = response['answer']
-    # Use .get() to safely access 'context'
-    context = response.get("context") 
-
-    # Clean up and format context sources for the client
-    formatted_context = None
-    if context:
-        formatted_context = []
-        seen_sources = set()
-        for doc in context:
-            source_path = doc.metadata.get("source")
-            page_number = doc.metadata.get("page")
-            
-            # Ensure we have valid source and page info
-            if source_path and page_number is not None:
-                # Assuming the source path starts with 'uploads/' (8 characters)
-                source_name = source_path[8:] 
-                page = int(page_number) + 1 # Page numbers are often 0-indexed, so add 1
-                
-                # Create a unique key (Source + Page)
-                unique_key = (source_name, page)
-                
-                if unique_key not in seen_sources:
-                    formatted_context.append({"source": source_name, "page": page})
-                    seen_sources.add(unique_key)
+    # Wall-clock time, so the embedding and LLM HTTP calls are included
+    start = time.perf_counter()
+
+    # Answer exact repeats (ignoring case and spacing) for this corpus directly
+    answer_key = (vectors.corpus_key, k, ' '.join(question.lower().split()))
+    cached = answer_cache.get(answer_key)
+    if cached is not None:
+        return cached_response(cached, start, stream)
+
+    query_embedding, docs = query_batcher.submit(vectors, question, k)
+
+    # Answer near-duplicate questions from the semantic cache, which only
+    # holds answers built from the default number of chunks
+    query_vector = SemanticCache.normalize(query_embedding)
+    semantic_cache = None
+    if k == app.config['RETRIEVAL_K']:
+        semantic_cache = vectors.get_semantic_cache()
+        cached = semantic_cache.lookup(query_vector)
+        if cached is not None:
+            answer_cache.put(answer_key, cached)
+            return cached_response(cached, start, stream)
+
+    context = stable_chunk_order(docs)
+    # Cite sources by relevance, not in the prompt's document order
+    formatted_context = format_context(docs)
+
+    if stream:
+        return Response(
+            stream_answer(question, context, formatted_context, answer_key, query_vector, semantic_cache, start),
+            mimetype='text/event-stream',
+        )
+
+    answer = document_chain.invoke({'input': question, 'context': context})
+    response_time = time.perf_counter() - start
+    ask_latency.labels(cache='miss').observe(response_time)
 
+    remember_answer(answer_key, query_vector, semantic_cache, {"answer": answer, "context": formatted_context})
 
     return jsonify({
         "answer": answer,
@@ -152,13 +1163,22 @@ def ask_question():
 def get_pdf(pdf_name):
     pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_name)
     if os.path.exists(pdf_path):
-        return send_from_directory(app.config['UPLOAD_FOLDER'], pdf_name)
+        if app.config['PDF_ACCEL_REDIRECT']:
+            # Let nginx send the file itself instead of streaming it through a worker
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = app.config['PDF_ACCEL_REDIRECT'] + cached_secure_filename(pdf_name)
+            response.headers['Content-Type'] = 'application/pdf'
+            return response
+        return send_from_directory(
+            app.config['UPLOAD_FOLDER'], pdf_name, conditional=True, max_age=app.config['PDF_MAX_AGE']
+        )
     else:
         return jsonify({"error": "PDF not found"}), 404
 
 @app.route('/get-pdf-names', methods=['GET'])
 def get_pdf_names():
-    return jsonify({"pdfNames": app.config['PDF_FILENAMES']}), 200
+    return jsonify({"pdfNames": current_pdf_filenames()}), 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn_conf.py)
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,44 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Workers only share the current corpus through Redis (REDIS_URL), so run a
+# single worker without it and rely on threads for concurrency.
+default_workers = (os.cpu_count() or 1) * 2 + 1 if os.environ.get("REDIS_URL") else 1
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+
+# Threads rather than gevent: the Gemini client talks gRPC, which does not
+# cooperate with gevent's monkey-patching. /ask mostly waits on network I/O,
+# so threads overlap those waits just as well.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Import the app once in the master so workers share its code and library
+# pages copy-on-write and boot faster. The embedding client (a gRPC channel,
+# or an ONNX Runtime session with its own thread pool) is not fork-safe, so
+# the app builds it lazily in each worker instead of sharing the master's.
+preload_app = True
+
+def post_worker_init(worker):
+    # Build this worker's embedding client (and load and warm a local model)
+    # before it accepts requests, so the first upload or question does not wait
+    import app
+    app.embeddings.get()
+
+def on_starting(server):
+    # Samples left in PROMETHEUS_MULTIPROC_DIR by a previous run would be
+    # added to this run's metrics
+    folder = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):
+            os.unlink(os.path.join(folder, name))
+
+def child_exit(server, worker):
+    # Drop the live-gauge samples of a worker that exited or was replaced
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+# Uploads embed every page before responding
+timeout = 120